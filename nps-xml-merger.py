@@ -10,25 +10,63 @@ This script merges multiple XML files while preserving the hierarchical structur
 and deduplicating elements that have <Properties> as a child element.
 Particularly useful for Windows NPS export files and similar hierarchical configurations.
 
+Requires the lxml package (pip install lxml).
+
 Usage:
     python xml_merger.py [options] input1.xml input2.xml [input3.xml ...] -o output.xml
 
 Options:
     -o, --output      Output file path (default: merged.xml)
     -v, --verbose     Enable verbose output
+    --lowmem          Stream the base file instead of loading it whole
+    -j, --jobs        Parse up to this many merge files in parallel (default: 1)
     -h, --help        Show help message
 """
 
 import os
+import copy
 import sys
 import argparse
-import xml.etree.ElementTree as ET
+from lxml import etree as ET
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+    import hashlib
+
+# Fixed XPath expressions, compiled once at module load
+_XP_ALL = ET.XPath(".//*")
+_XP_CHILDREN = ET.XPath(".//Children")
+_XP_CLIENTS = ET.XPath(".//Clients/Children")
+_XP_BY_TAG_CHILD = ET.XPath(".//*[tag=$t]")
+
+_XML_NS = "http://www.w3.org/XML/1998/namespace"
+_XML_NS_PREFIX = "{" + _XML_NS + "}"
+
+@lru_cache(maxsize=None)
+def _compile_xpath(expression):
+    """Compile a dynamically assembled XPath expression, caching the result."""
+    return ET.XPath(expression)
 
 def parse_xml_file(file_path):
     """Parse an XML file with error handling."""
     try:
-        return ET.parse(file_path)
+        parser = ET.XMLParser(remove_blank_text=True, huge_tree=True)
+        return ET.parse(file_path, parser)
+    except ET.ParseError as e:
+        print(f"Error parsing {file_path}: {str(e)}")
+        print("Please ensure your XML file is properly formatted.")
+        raise
+
+def iterparse_xml_file(file_path):
+    """Stream-parse an XML file with error handling, yielding each element once it is complete."""
+    try:
+        for _, elem in ET.iterparse(file_path, events=("end",), remove_blank_text=True, huge_tree=True):
+            yield elem
     except ET.ParseError as e:
         print(f"Error parsing {file_path}: {str(e)}")
         print("Please ensure your XML file is properly formatted.")
@@ -36,8 +74,44 @@ def parse_xml_file(file_path):
 
 def get_element_id(element):
     """Generate a unique identifier for an element based on tag and name attribute."""
-    name = element.get('name', '')
-    return f"{element.tag}:{name}"
+    return element.tag + ":" + (element.get('name') or '')
+
+def _hash_bytes(data):
+    """Return a fast 64-bit non-cryptographic hash of data."""
+    if xxhash is not None:
+        return xxhash.xxh3_64_intdigest(data)
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'big')
+
+def get_element_hash(element):
+    """
+    Generate a content hash for an element, used as its deduplication key.
+    
+    Leaf elements (clients, policies, profiles...) are hashed on their canonical
+    serialization, so entries sharing a name but differing in content are both kept.
+    Containers (elements with a Children child) are hashed on tag and name only,
+    since their contents are merged element by element.
+    """
+    if element.find("Children") is not None:
+        return _hash_bytes((element.tag + ":" + (element.get('name') or '')).encode('utf-8'))
+    return _hash_bytes(ET.tostring(element, method="c14n", exclusive=True))
+
+def has_new_container_ancestor(element, seen_hashes):
+    """
+    Check whether the element sits inside a container with Properties that is not
+    yet in the base XML. Such elements are merged along with that container.
+    """
+    for ancestor in element.iterancestors():
+        if ancestor.getparent() is None:
+            # The root is never merged itself
+            break
+        if ancestor.tag == "Children":
+            # Only wraps siblings; searching a fully parsed one is costly
+            continue
+        if ancestor.find("Children") is None or ancestor.find("Properties") is None:
+            continue
+        if get_element_hash(ancestor) not in seen_hashes:
+            return True
+    return False
 
 def get_element_path(element, root):
     """
@@ -47,11 +121,12 @@ def get_element_path(element, root):
     path = []
     current = element
     
-    # This is a very simplified approach since ElementTree doesn't track parents
-    # In a real scenario, we'd need to search through the entire tree
+    # lxml tracks parents, so walk up until we reach the root
+    while current is not None and current is not root:
+        path.append((current.tag, current.get('name', '')))
+        current = current.getparent()
     
-    # Just return the element's tag since we can't easily determine the path
-    path.append((element.tag, element.get('name', '')))
+    path.reverse()
     return path
 
 def find_parent_by_path(root, path):
@@ -93,21 +168,18 @@ def find_matching_parent(base_root, element_tag, element_name, target_parent_tag
     """
     # If a specific parent tag is provided, look for it
     if target_parent_tag:
-        parents = base_root.findall(f".//*[tag='{target_parent_tag}']")
+        parents = _XP_BY_TAG_CHILD(base_root, t=target_parent_tag)
         if parents:
             return parents[0]
     
     # Look for existing siblings with the same tag
-    siblings = base_root.findall(f".//*/{element_tag}")
+    siblings = _compile_xpath(f".//*/{element_tag}")(base_root)
     if siblings:
         # Return the parent of the first sibling
-        for parent in base_root.findall(".//*"):
-            for child in parent:
-                if child.tag == element_tag:
-                    return parent
+        return siblings[0].getparent()
     
     # If no siblings found, try to find a "Children" container
-    children_containers = base_root.findall(".//Children")
+    children_containers = _XP_CHILDREN(base_root)
     if children_containers:
         # Look for an appropriate container by checking its immediate children
         for container in children_containers:
@@ -132,16 +204,157 @@ def get_existing_parent_map(root):
     Create a map of each tag to its potential parent tags in the existing XML.
     This helps determine where new elements should go.
     """
-    parent_map = defaultdict(set)
+    parent_map = defaultdict(list)
     
     # For each element in the tree, record its children's tags
-    for parent in root.findall(".//*"):
+    for parent in _XP_ALL(root):
         for child in parent:
-            parent_map[child.tag].add(parent.tag)
+            parent_map[child.tag].append(parent.tag)
     
-    return parent_map
+    # Deduplicate once, keeping first-seen order; the map is read-only from here
+    return {tag: tuple(dict.fromkeys(parent_tags)) for tag, parent_tags in parent_map.items()}
+
+# Container paths (relative to the root) for elements that belong in well-known NPS sections
+CLIENTS_PATH = "Children/Microsoft_Internet_Authentication_Service/Children/Protocols/Children/Microsoft_Radius_Protocol/Children/Clients/Children"
+
+KNOWN_CONTAINERS = {
+    # For RadiusProfiles
+    "RadiusProfiles": "Children/Microsoft_Internet_Authentication_Service/Children/RadiusProfiles/Children",
+    # For NetworkPolicy
+    "NetworkPolicy": "Children/Microsoft_Internet_Authentication_Service/Children/NetworkPolicy/Children",
+    # For Proxy_Policies
+    "Proxy_Policies": "Children/Microsoft_Internet_Authentication_Service/Children/Proxy_Policies/Children",
+    # For Proxy_Profiles
+    "Proxy_Profiles": "Children/Microsoft_Internet_Authentication_Service/Children/Proxy_Profiles/Children",
+    # For RADIUS server groups
+    "RADIUS_Server_Groups": "Children/Microsoft_Internet_Authentication_Service/Children/RADIUS_Server_Groups/Children",
+    # For Vendors
+    "Vendors": "Children/Microsoft_Internet_Authentication_Service/Children/Protocols/Children/Microsoft_Radius_Protocol/Children/Vendors/Children"
+}
+
+def find_path(root, path):
+    """Return the first element at the given root-relative path, or None if it doesn't exist."""
+    matches = _compile_xpath(path)(root)
+    return matches[0] if matches else None
+
+def _index_element(index, elem):
+    """Record a single element in the parent index."""
+    name = elem.get('name')
+    if name is not None:
+        index["by_tag_name"].setdefault((elem.tag, name), elem)
+    index["by_tag"].setdefault(elem.tag, elem)
+    
+    # Remember which Children containers already hold each child tag
+    if elem.tag == "Children":
+        for child in elem.iterchildren(ET.Element):
+            containers = index["children_by_childtag"][child.tag]
+            if not containers or containers[-1] is not elem:
+                containers.append(elem)
+
+def _is_radius_client(element, index):
+    """Check whether the element is a RADIUS client (IP_Address in Properties) and the base has a clients container."""
+    return index["clients"] is not None and element.find("Properties/IP_Address") is not None
+
+def _make_container_handler(index, container):
+    """Build the parent lookup for elements whose tag names a resolved known container."""
+    def handler(element):
+        if _is_radius_client(element, index):
+            return index["clients"]
+        return container
+    return handler
 
-def find_correct_parent(base_root, element, source_root=None):
+def _may_complete_path(new_element, path):
+    """
+    Check whether appending new_element could have created the element at path.
+    
+    The parent new_element went under already existed, so a path that was missing
+    before can only exist now if new_element is one of its steps.
+    """
+    return new_element.tag in path.split("/")
+
+def _resolve_containers(index, base_root, new_element=None):
+    """
+    Resolve any known containers that are not yet present in the index.
+    
+    If new_element is given, only the containers it could have created are looked up.
+    """
+    resolved = index["resolved"]
+    for container_name, path in KNOWN_CONTAINERS.items():
+        if resolved.get(container_name) is None:
+            if new_element is not None and not _may_complete_path(new_element, path):
+                continue
+            container = find_path(base_root, path)
+            resolved[container_name] = container
+            if container is not None:
+                for member in container.iterchildren(ET.Element):
+                    index["container_by_member_tag"].setdefault(member.tag, container)
+                index["handlers"][container_name] = _make_container_handler(index, container)
+    
+    if index["clients"] is None:
+        if new_element is None or _may_complete_path(new_element, CLIENTS_PATH):
+            index["clients"] = find_path(base_root, CLIENTS_PATH)
+        # Fallback: try a simpler path search, which a Clients element anywhere
+        # in the new subtree could satisfy
+        if index["clients"] is None and (new_element is None or new_element.tag == "Children"
+                                         or next(new_element.iter("Clients"), None) is not None):
+            clients_containers = _XP_CLIENTS(base_root)
+            if clients_containers:
+                index["clients"] = clients_containers[0]
+
+def build_parent_index(base_root):
+    """
+    Walk the base XML once and index it so parent lookups don't rescan the tree.
+    
+    Args:
+        base_root: The root element of the base XML
+        
+    Returns:
+        A dict holding the lookup tables used by find_correct_parent
+    """
+    index = {
+        # First element for each (tag, name attribute) pair
+        "by_tag_name": {},
+        # First element for each tag
+        "by_tag": {},
+        # Child tag -> Children containers that already hold one, in document order
+        "children_by_childtag": defaultdict(list),
+        # Known container name -> resolved container element (or None)
+        "resolved": {},
+        # Member tag -> known container that already holds such an element
+        "container_by_member_tag": {},
+        # Element tag -> parent lookup specialized for this base tree
+        "handlers": {},
+        # Container for RADIUS clients (or None)
+        "clients": None,
+    }
+    
+    for elem in base_root.iterdescendants(ET.Element):
+        _index_element(index, elem)
+    
+    _resolve_containers(index, base_root)
+    return index
+
+def add_to_parent_index(index, base_root, parent, new_element):
+    """
+    Update the parent index after new_element has been appended to parent,
+    so subsequent merges see the new slots.
+    """
+    for elem in new_element.iter(ET.Element):
+        _index_element(index, elem)
+    
+    if parent.tag == "Children":
+        containers = index["children_by_childtag"][new_element.tag]
+        if parent not in containers:
+            containers.append(parent)
+    
+    if parent in index["resolved"].values():
+        index["container_by_member_tag"].setdefault(new_element.tag, parent)
+    
+    # The new subtree may have created a previously missing container
+    if None in index["resolved"].values() or index["clients"] is None:
+        _resolve_containers(index, base_root, new_element)
+
+def find_correct_parent(base_root, element, source_root=None, index=None):
     """
     Find the correct parent in the base XML tree for the given element.
     
@@ -154,115 +367,216 @@ def find_correct_parent(base_root, element, source_root=None):
         base_root: The root element of the base XML
         element: The element to place
         source_root: The root element of the source XML (for context)
+        index: Parent index from build_parent_index (built on demand if omitted)
         
     Returns:
         The appropriate parent element in the base XML
     """
-    element_tag = element.tag
-    element_name = element.get('name', '')
+    if index is None:
+        index = build_parent_index(base_root)
     
-    # Check if this element has a Properties child
-    has_properties = any(child.tag == "Properties" for child in element)
+    element_tag = element.tag
     
-    # Helper function to check if an element exists at a specific path
-    def find_path(root, path):
-        current = root
-        for segment in path.split('/'):
-            if not segment:
-                continue
-            found = False
-            for child in current:
-                if child.tag == segment:
-                    current = child
-                    found = True
-                    break
-            if not found:
-                return None
-        return current
+    # Known container tags have a handler pre-bound to their resolved container,
+    # so they never consult the source tree
+    handler = index["handlers"].get(element_tag)
+    if handler is not None:
+        return handler(element)
     
     # Handle RADIUS clients - elements with IP_Address in Properties
-    if has_properties:
-        properties = element.find("./Properties")
-        if properties is not None:
-            has_ip = any(prop.tag == "IP_Address" for prop in properties)
-            if has_ip:
-                # This is a RADIUS client, look for the clients container
-                client_path = "Children/Microsoft_Internet_Authentication_Service/Children/Protocols/Children/Microsoft_Radius_Protocol/Children/Clients/Children"
-                clients_container = find_path(base_root, client_path)
-                if clients_container is not None:
-                    return clients_container
-                
-                # Fallback: try a simpler path search
-                clients_containers = base_root.findall(".//Clients/Children")
-                if clients_containers:
-                    return clients_containers[0]
+    if _is_radius_client(element, index):
+        return index["clients"]
     
     # Look for the exact same parent path structure in the base XML
     if source_root is not None:
-        # Try to determine the parent's path in the source XML
-        for parent in source_root.findall(".//*"):
-            for child in parent:
-                if child == element or (child.tag == element.tag and child.get('name') == element_name):
-                    # Found the parent in the source, now find the same path in base
-                    parent_tag = parent.tag
-                    parent_name = parent.get('name', '')
-                    
-                    # Look for a matching parent in the base XML
-                    for base_parent in base_root.findall(f".//*[@name='{parent_name}']"):
-                        if base_parent.tag == parent_tag:
-                            return base_parent
-                    
-                    # If no exact match, try just the tag
-                    for base_parent in base_root.findall(f".//{parent_tag}"):
-                        return base_parent
-    
-    # Handle specific NPS elements by likely container
-    known_containers = {
-        # For RadiusProfiles
-        "RadiusProfiles": "Children/Microsoft_Internet_Authentication_Service/Children/RadiusProfiles/Children",
-        # For NetworkPolicy
-        "NetworkPolicy": "Children/Microsoft_Internet_Authentication_Service/Children/NetworkPolicy/Children",
-        # For Proxy_Policies
-        "Proxy_Policies": "Children/Microsoft_Internet_Authentication_Service/Children/Proxy_Policies/Children",
-        # For Proxy_Profiles
-        "Proxy_Profiles": "Children/Microsoft_Internet_Authentication_Service/Children/Proxy_Profiles/Children",
-        # For RADIUS server groups
-        "RADIUS_Server_Groups": "Children/Microsoft_Internet_Authentication_Service/Children/RADIUS_Server_Groups/Children",
-        # For Vendors
-        "Vendors": "Children/Microsoft_Internet_Authentication_Service/Children/Protocols/Children/Microsoft_Radius_Protocol/Children/Vendors/Children"
-    }
-    
-    # First check direct element tag match
-    for container_name, path in known_containers.items():
-        if element_tag == container_name:
-            container = find_path(base_root, path)
-            if container is not None:
-                return container
+        # The element's parent in the source XML is tracked by lxml
+        parent = element.getparent()
+        if parent is not None:
+            # Found the parent in the source, now find the same path in base
+            parent_tag = parent.tag
+            parent_name = parent.get('name', '')
+            
+            # Look for a matching parent in the base XML
+            base_parent = index["by_tag_name"].get((parent_tag, parent_name))
+            if base_parent is not None:
+                return base_parent
+            
+            # If no exact match, try just the tag
+            base_parent = index["by_tag"].get(parent_tag)
+            if base_parent is not None:
+                return base_parent
     
     # Then check if the element belongs in one of these containers
-    for container_name, path in known_containers.items():
-        # Look for existing elements with same tag in this container
-        container = find_path(base_root, path)
-        if container is not None:
-            for child in container:
-                if child.tag == element_tag:
-                    return container
+    container = index["container_by_member_tag"].get(element_tag)
+    if container is not None:
+        return container
     
     # Look for a Children element that already has this element's tag
-    for children in base_root.findall(".//Children"):
-        for child in children:
-            if child.tag == element_tag:
-                return children
+    containers_with_tag = index["children_by_childtag"].get(element_tag)
+    if containers_with_tag:
+        return containers_with_tag[0]
     
     # Last resort - find a generic Children container
-    children_containers = base_root.findall(".//Children")
-    if children_containers:
-        return children_containers[0]
+    children_container = index["by_tag"].get("Children")
+    if children_container is not None:
+        return children_container
     
     # Absolute last resort: return the root
     return base_root
 
-def merge_xml_files(input_files, output_file, verbose=False):
+def load_base_skeleton(file_path):
+    """
+    Stream-parse the base file for low-memory mode.
+    
+    Every element with Properties is hashed for deduplication as it completes. Leaf
+    entries (no Children child) are then cut down to empty stubs keeping only their
+    tag and name, so the DOM held in memory is a skeleton of the containers that new
+    elements can be appended to. Stubs keep sibling positions intact for
+    write_with_additions.
+    
+    Returns:
+        A (skeleton root, seen element hashes) tuple
+    """
+    root = None
+    seen_hashes = set()
+    
+    for elem in iterparse_xml_file(file_path):
+        if elem.getparent() is None:
+            root = elem
+            continue
+        if elem.find("Properties") is None:
+            continue
+        
+        seen_hashes.add(get_element_hash(elem))
+        if elem.find("Children") is None:
+            name = elem.get('name')
+            elem.clear()
+            if name is not None:
+                elem.set('name', name)
+    
+    return root, seen_hashes
+
+def _position_path(element):
+    """Return the element's position in its tree as a tuple of element-only child indices."""
+    path = []
+    parent = element.getparent()
+    while parent is not None:
+        path.append(sum(1 for _ in element.itersiblings(ET.Element, preceding=True)))
+        element, parent = parent, parent.getparent()
+    return tuple(reversed(path))
+
+def collect_additions(skeleton_root, skeleton):
+    """
+    Find the elements merged into a base skeleton.
+    
+    Args:
+        skeleton_root: The root of the skeleton returned by load_base_skeleton
+        skeleton: Set of the skeleton's own elements, taken before merging
+        
+    Returns:
+        A dict mapping the position path of each base element to the new children
+        appended under it
+    """
+    additions = {}
+    for elem in skeleton:
+        new_children = [child for child in elem.iterchildren(ET.Element) if child not in skeleton]
+        if new_children:
+            additions[_position_path(elem)] = new_children
+    return additions
+
+def _serialize_in_scope(element, scope_nsmap):
+    """
+    Serialize an element for writing inside an already open element.
+    
+    Serialized on its own, an element carries declarations for every namespace it
+    uses. Each declaration on its start tag that binds the same prefix to the same
+    URI as scope_nsmap is removed; all others, and any on descendants, are kept.
+    This relies on lxml writing declarations as ` xmlns:prefix="uri"` and escaping
+    '>' and '"' in attribute values, so the first '>' ends the start tag and a
+    declaration can't be matched inside an attribute value.
+    
+    A declaration the source repeated on the element itself is redundant in scope
+    and is removed too, where the default writer would keep it.
+    
+    Args:
+        element: The element to serialize
+        scope_nsmap: Prefix -> URI map of the namespaces in scope where it is written
+        
+    Returns:
+        The UTF-8 encoded element, without its tail
+    """
+    data = ET.tostring(element, encoding='utf-8', with_tail=False)
+    tag_end = data.index(b">")
+    start_tag = data[:tag_end]
+    for prefix, uri in scope_nsmap.items():
+        declaration = b' xmlns="' if prefix is None else b' xmlns:' + prefix.encode('utf-8') + b'="'
+        start_tag = start_tag.replace(declaration + uri.encode('utf-8') + b'"', b"", 1)
+    return start_tag + data[tag_end:]
+
+def write_with_additions(base_file, output_file, additions, indent="  "):
+    """
+    Stream the base file to the output, writing merged-in elements at the end of
+    their containers as it goes, so the full base DOM is never held in memory.
+    
+    Elements are opened incrementally only once they turn out to have child elements;
+    leaf elements and merged-in subtrees are written whole, without re-declaring
+    namespaces already in scope. Comments and mixed-content tails are not carried
+    over; NPS exports use neither.
+    """
+    with open(output_file, 'wb') as f:
+        with ET.xmlfile(f, encoding='utf-8') as xf:
+            xf.write_declaration()
+            
+            def write_whole(element, scope_nsmap):
+                # xmlfile would serialize the element out of context, so write it directly
+                xf.flush()
+                f.write(_serialize_in_scope(element, scope_nsmap))
+            
+            def write_element(events, elem, position, scope_nsmap, depth):
+                # Called once elem has started; consumes the events up to its end
+                event, child = next(events)
+                new_children = additions.get(position, ())
+                
+                if event == "end" and not new_children:
+                    # No child elements, so nothing else will be written inside it
+                    write_whole(elem, scope_nsmap)
+                else:
+                    nsmap = {prefix: uri for prefix, uri in elem.nsmap.items() if scope_nsmap.get(prefix) != uri}
+                    if any(key.startswith(_XML_NS_PREFIX) for key in elem.attrib):
+                        # xmlfile doesn't know the reserved xml prefix unless it is declared
+                        nsmap['xml'] = _XML_NS
+                    
+                    with xf.element(elem.tag, dict(elem.attrib), nsmap=nsmap or None):
+                        if elem.text:
+                            xf.write(elem.text)
+                        child_index = 0
+                        while event == "start":
+                            xf.write("\n" + indent * (depth + 1))
+                            write_element(events, child, position + (child_index,), elem.nsmap, depth + 1)
+                            child_index += 1
+                            event, child = next(events)
+                        
+                        for new_element in new_children:
+                            ET.indent(new_element, space=indent, level=depth + 1)
+                            xf.write("\n" + indent * (depth + 1))
+                            write_whole(new_element, elem.nsmap)
+                        xf.write("\n" + indent * depth)
+                
+                # Drop what has been written so memory stays flat; the root's
+                # preceding siblings are comments or PIs outside the tree
+                elem.clear()
+                if elem.getparent() is not None:
+                    while elem.getprevious() is not None:
+                        del elem.getparent()[0]
+            
+            events = ET.iterparse(base_file, events=("start", "end"), remove_blank_text=True, huge_tree=True)
+            _, root = next(events)
+            write_element(events, root, (), {}, 0)
+        
+        # Match the trailing newline of the default writer
+        f.write(b"\n")
+
+def merge_xml_files(input_files, output_file, verbose=False, lowmem=False, jobs=1):
     """
     Merge multiple XML files, preserving hierarchy and deduplicating elements with Properties.
     
@@ -270,92 +584,113 @@ def merge_xml_files(input_files, output_file, verbose=False):
         input_files: List of input XML file paths
         output_file: Path to the output merged XML file
         verbose: Whether to output verbose logs
+        lowmem: Keep only a skeleton of the base file in memory and stream it
+            to the output, for very large base files
+        jobs: Number of merge files to parse concurrently. With more than one,
+            merge files are parsed whole in the background instead of streamed
     
     Returns:
-        True if successful, False otherwise
+        True if successful, False otherwise. A merge file that fails part way
+        through keeps the elements merged before the error, and makes this False
+        once the output has been written.
     """
     if not input_files:
         print("Error: No input files provided")
         return False
     
+    executor = None
     try:
+        # Start parsing the merge files in the background; lxml releases the GIL
+        # while parsing, so threads overlap with the base parse and with merging
+        parsed_merge_files = None
+        if jobs > 1 and len(input_files) > 2:
+            executor = ThreadPoolExecutor(max_workers=jobs)
+            parsed_merge_files = [executor.submit(parse_xml_file, file_path) for file_path in input_files[1:]]
+        
         # Parse the base file
         print(f"Using {input_files[0]} as base file")
-        base_tree = parse_xml_file(input_files[0])
-        base_root = base_tree.getroot()
-        
-        # Track elements by their unique identifiers to avoid duplicates
-        seen_elements = {}
+        if lowmem:
+            # Catalog the base file while streaming it, keeping only a skeleton
+            base_root, seen_hashes = load_base_skeleton(input_files[0])
+            skeleton = set(base_root.iter())
+        else:
+            base_tree = parse_xml_file(input_files[0])
+            base_root = base_tree.getroot()
+            
+            # Track element hashes to avoid duplicates
+            seen_hashes = set()
+            
+            # First, catalog all existing elements in the base file that have Properties
+            for props in base_root.iter("Properties"):
+                elem = props.getparent()
+                if elem is not base_root:
+                    seen_hashes.add(get_element_hash(elem))
         
-        # First, catalog all existing elements in the base file that have Properties
-        for elem in base_root.findall(".//*"):
-            has_properties = any(child.tag == "Properties" for child in elem)
-            if has_properties:
-                key = get_element_id(elem)
-                seen_elements[key] = elem
+        # Index the base file once so parent lookups don't rescan the tree
+        parent_index = build_parent_index(base_root)
         
         if verbose:
-            print(f"Found {len(seen_elements)} unique elements with Properties in base file")
+            print(f"Found {len(seen_hashes)} unique elements with Properties in base file")
+        
+        # Merge files that hit an error, possibly after some of their elements were merged
+        failed_files = []
         
         # Process each additional file
         for file_idx, file_path in enumerate(input_files[1:], 1):
             print(f"Merging file {file_idx}: {file_path}")
             try:
-                merge_tree = parse_xml_file(file_path)
-                merge_root = merge_tree.getroot()
-                
-                # Count of new elements added
+                # Count of elements with Properties, and of new elements added
+                candidates_count = 0
                 new_elements_count = 0
                 
-                # First, identify all elements with Properties in the merge file
-                elements_with_properties = []
-                for elem in merge_root.findall(".//*"):
-                    has_properties = any(child.tag == "Properties" for child in elem)
-                    if has_properties:
-                        elements_with_properties.append(elem)
-                
-                if verbose:
-                    print(f"  Found {len(elements_with_properties)} elements with Properties in {file_path}")
+                # Walk the merge file, handling each element with Properties once it is complete
+                if parsed_merge_files is not None:
+                    merge_tree = parsed_merge_files[file_idx - 1].result()
+                    parsed_merge_files[file_idx - 1] = None
+                    merge_elements = (elem for _, elem in ET.iterwalk(merge_tree, events=("end",)))
+                else:
+                    merge_elements = iterparse_xml_file(file_path)
                 
-                # For each element with Properties, find its correct location in the base file
-                for element in elements_with_properties:
-                    # Create a unique identifier for this element
-                    key = get_element_id(element)
-                    
-                    # Skip if we've already seen this element
-                    if key in seen_elements:
-                        if verbose:
-                            print(f"  Skipping duplicate: {key}")
+                for element in merge_elements:
+                    source_parent = element.getparent()
+                    if source_parent is None or element.find("Properties") is None:
                         continue
+                    candidates_count += 1
                     
-                    # Find the correct parent in the base XML
-                    parent_in_base = find_correct_parent(base_root, element, merge_root)
+                    # Elements inside a container that is new to the base are copied along with it
+                    if has_new_container_ancestor(element, seen_hashes):
+                        continue
                     
-                    if parent_in_base is not None:
-                        # Clone the element
-                        new_element = ET.Element(element.tag)
-                        new_element.attrib = element.attrib.copy()
+                    # Skip if we've already seen this element
+                    if get_element_hash(element) in seen_hashes:
+                        if verbose:
+                            print(f"  Skipping duplicate: {get_element_id(element)}")
+                    else:
+                        # Find the correct parent in the base XML
+                        merge_root = element.getroottree().getroot()
+                        parent_in_base = find_correct_parent(base_root, element, merge_root, parent_index)
                         
-                        # Copy all children including Properties
-                        for child in element:
-                            child_elem = ET.SubElement(new_element, child.tag)
-                            child_elem.attrib = child.attrib.copy()
-                            if child.text:
-                                child_elem.text = child.text
+                        if parent_in_base is not None:
+                            # Clone the element with its full subtree (including Properties)
+                            new_element = copy.deepcopy(element)
+                            new_element.tail = None
                             
-                            # Copy grandchildren (especially for Properties)
-                            for grandchild in child:
-                                gc_elem = ET.SubElement(child_elem, grandchild.tag)
-                                gc_elem.attrib = grandchild.attrib.copy()
-                                if grandchild.text:
-                                    gc_elem.text = grandchild.text
-                        
-                        # Add to the base XML
-                        parent_in_base.append(new_element)
-                        seen_elements[key] = new_element
-                        new_elements_count += 1
-                    else:
-                        print(f"  Warning: Could not find appropriate parent for {key}")
+                            # Add to the base XML
+                            parent_in_base.append(new_element)
+                            add_to_parent_index(parent_index, base_root, parent_in_base, new_element)
+                            
+                            # Everything copied along with it is now present in the base
+                            for props in new_element.iter("Properties"):
+                                seen_hashes.add(get_element_hash(props.getparent()))
+                            new_elements_count += 1
+                        else:
+                            print(f"  Warning: Could not find appropriate parent for {get_element_id(element)}")
+                    
+                    # Drop the processed subtree so memory stays flat on large files
+                    source_parent.remove(element)
+                
+                if verbose:
+                    print(f"  Found {candidates_count} elements with Properties in {file_path}")
                 
                 print(f"  Added {new_elements_count} new elements from {file_path}")
             
@@ -364,26 +699,36 @@ def merge_xml_files(input_files, output_file, verbose=False):
                 if verbose:
                     import traceback
                     traceback.print_exc()
-                print(f"Skipping this file and continuing with others.")
+                print(f"Skipping the rest of this file and continuing with others.")
+                failed_files.append(file_path)
                 continue
         
-        # Write the merged tree to the output file
+        # Write the merged tree to a temporary file next to the output, and only
+        # replace the output once it is complete
+        temp_file = output_file + ".tmp"
         try:
-            # Add XML declaration and format the output
-            with open(output_file, 'wb') as f:
-                f.write(b'<?xml version="1.0" encoding="utf-8"?>\n')
-                try:
-                    ET.indent(base_tree)  # Python 3.9+ feature
-                except AttributeError:
-                    print("Note: XML indentation not available (requires Python 3.9+)")
-                    
-                base_tree.write(f, encoding='utf-8', xml_declaration=False)
+            if lowmem:
+                # Re-stream the base file, writing new elements into their containers
+                additions = collect_additions(base_root, skeleton)
+                write_with_additions(input_files[0], temp_file, additions)
+            else:
+                # Add XML declaration and stream the formatted tree straight to the file
+                with ET.xmlfile(temp_file, encoding='utf-8') as xf:
+                    xf.write_declaration()
+                    xf.write(base_root, pretty_print=True)
+            os.replace(temp_file, output_file)
+            
+            if failed_files:
+                print(f"Merged XML files into {output_file}, but these files could not be fully merged: {', '.join(failed_files)}")
+                return False
             
             print(f"Successfully merged XML files into {output_file}")
             return True
         
         except Exception as e:
             print(f"Error writing output file: {str(e)}")
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
             return False
     
     except Exception as e:
@@ -392,6 +737,10 @@ def merge_xml_files(input_files, output_file, verbose=False):
             import traceback
             traceback.print_exc()
         return False
+    
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
 
 def main():
     parser = argparse.ArgumentParser(
@@ -400,6 +749,10 @@ def main():
     parser.add_argument('input_files', nargs='+', help='Input XML files to merge')
     parser.add_argument('-o', '--output', default='merged.xml', help='Output file (default: merged.xml)')
     parser.add_argument('-v', '--verbose', action='store_true', help='Enable verbose output')
+    parser.add_argument('--lowmem', action='store_true',
+                        help='Stream the base file instead of loading it whole (for very large exports)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Parse up to this many merge files in parallel (uses more memory; default: 1)')
     args = parser.parse_args()
     
     # Validate input files
@@ -415,7 +768,7 @@ def main():
         return 1
     
     # Perform the merge
-    success = merge_xml_files(valid_files, args.output, args.verbose)
+    success = merge_xml_files(valid_files, args.output, args.verbose, args.lowmem, args.jobs)
     return 0 if success else 1
 
 if __name__ == "__main__":